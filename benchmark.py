@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+Reproducible benchmarks for the hot paths of the utility modules.
+
+Each scenario is run in its own process (so peak memory isn't polluted by
+the other scenarios) with a fixed random seed. For every scenario the
+ops/sec, the percentiles of the latency per operation (measured over many
+separately timed batches) and the peak resident memory are reported.
+Results can be saved as a JSON baseline and later runs compared against
+it to flag regressions:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+
+make_hist is benchmarked with a stand-in backend if ROOT is not available.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+from multiprocessing import Pool
+from time import strftime
+from timeit import default_timer
+
+from ValueWithError import ValueWithError
+from list_utilities import traverse, printTraverse, add_as_sub_dict, \
+                           create_sub_dicts_from_keys
+from password_gen import gen_password, get_char_set
+import root_utilities
+
+SEED = 20131018
+
+
+class BenchmarkException(Exception):
+    pass
+
+
+# name -> (function, description) in the order they were registered
+scenarios = {}
+scenario_order = []
+
+def scenario(description):
+    """
+    Register a scenario.
+
+    The decorated function is called as f(scale, n_batches) and must do any
+    set up then return (batches, reset). batches is a list of up to
+    n_batches (op, n_ops) pairs, where op is a function taking no arguments
+    that is timed and n_ops the number of operations it performs. Scenarios
+    that must work on the whole input at once return a single batch. reset
+    is None or a function called (untimed) before each pass over the
+    batches. scale multiplies the size of the problem.
+    """
+    def register(f):
+        scenarios[f.__name__] = (f, description)
+        scenario_order.append(f.__name__)
+        return f
+    return register
+
+
+def _scaled(n, scale):
+    return max(1, int(n*scale))
+
+
+def _split(items, n_batches):
+    """Split a list into at most n_batches slices of (nearly) equal size"""
+    step = max(1, -(-len(items)//n_batches))
+    return [items[i:i+step] for i in range(0, len(items), step)]
+
+
+@scenario("ValueWithError +, -, * and / between pairs")
+def vwe_arithmetic(scale, n_batches):
+    n = _scaled(20000, scale)
+    pairs = [(ValueWithError(random.uniform(1, 100), random.uniform(0.1, 5)),
+              ValueWithError(random.uniform(1, 100), random.uniform(0.1, 5)))
+             for i in range(n)]
+    def op(chunk):
+        for a, b in chunk:
+            a + b
+            a - b
+            a * b
+            a / b
+    return [(lambda c=c: op(c), 4*len(c)) for c in _split(pairs, n_batches)], \
+           None
+
+
+@scenario("sum() of a list of ValueWithError")
+def vwe_reduction(scale, n_batches):
+    n = _scaled(100000, scale)
+    values = [ValueWithError(random.uniform(1, 100)) for i in range(n)]
+    return [(lambda c=c: sum(c), len(c)) for c in _split(values, n_batches)], \
+           None
+
+
+def _make_deep_tree(depth, width):
+    tree = range(width)
+    for i in range(depth):
+        tree = [tree, i, "level"+str(i)]
+    return tree
+
+
+def _make_wide_tree(n_keys, width):
+    return dict(("key"+str(i), {'a':range(width), 'b':str(i)})
+                for i in range(n_keys))
+
+
+def _consume(iterable):
+    for i in iterable: pass
+
+
+@scenario("traverse a deeply nested list")
+def traverse_deep(scale, n_batches):
+    # depth is limited by the recursion limit, so scale the number of trees
+    trees = [_make_deep_tree(400, 10) for i in range(_scaled(200, scale))]
+    n_per_tree = sum(1 for i in traverse(trees[0]))
+    return [(lambda c=c: _consume(i for t in c for i in traverse(t)),
+             n_per_tree*len(c)) for c in _split(trees, n_batches)], None
+
+
+@scenario("traverse a wide dictionary of lists")
+def traverse_wide(scale, n_batches):
+    # a single batch so that each call walks the whole (wide) dictionary
+    tree = _make_wide_tree(_scaled(50000, scale), 10)
+    op = lambda: _consume(traverse(tree))
+    return [(op, sum(1 for i in traverse(tree)))], None
+
+
+def _print_to_devnull(tree):
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        printTraverse(tree)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+
+@scenario("printTraverse a deeply nested list to /dev/null")
+def print_traverse_deep(scale, n_batches):
+    trees = [_make_deep_tree(400, 10) for i in range(_scaled(100, scale))]
+    n_per_tree = sum(1 for i in traverse(trees[0], pmode=True))
+    def op(chunk):
+        for tree in chunk:
+            _print_to_devnull(tree)
+    return [(lambda c=c: op(c), n_per_tree*len(c))
+            for c in _split(trees, n_batches)], None
+
+
+@scenario("printTraverse a wide dictionary to /dev/null")
+def print_traverse_wide(scale, n_batches):
+    # a single batch so that each call prints the whole (wide) dictionary
+    tree = _make_wide_tree(_scaled(20000, scale), 10)
+    op = lambda: _print_to_devnull(tree)
+    return [(op, sum(1 for i in traverse(tree, pmode=True)))], None
+
+
+@scenario("add_as_sub_dict of 1M keys into 1000 sub-dictionaries")
+def add_sub_dict(scale, n_batches):
+    n = _scaled(1000000, scale)
+    items = [("key"+str(i%1000), "sub"+str(i), i) for i in range(n)]
+    # every batch adds to the same dictionary, emptied before each pass
+    d = {}
+    def op(chunk):
+        for key, subkey, val in chunk:
+            add_as_sub_dict(d, key, subkey, val)
+    return [(lambda c=c: op(c), len(c)) for c in _split(items, n_batches)], \
+           d.clear
+
+
+@scenario("create_sub_dicts_from_keys on a dictionary of 1M keys")
+def create_sub_dicts(scale, n_batches):
+    n = _scaled(1000000, scale)
+    flat = dict(("key{}_{}".format(i%1000, i), i) for i in range(n))
+    keysplit = lambda x: x.split('_', 1)
+    # a single batch so that each call gets all of the keys
+    return [(lambda: create_sub_dicts_from_keys(flat, keysplit), n)], None
+
+
+@scenario("gen_password of 16 characters from the readable set")
+def password(scale, n_batches):
+    n = _scaled(20000, scale)
+    char_set = get_char_set(all_char=False)
+    def op(count):
+        for i in range(count):
+            gen_password(16, char_set)
+    return [(lambda c=c: op(len(c)), len(c))
+            for c in _split(range(n), n_batches)], None
+
+
+class StandInAxis(object):
+    """Just enough of TAxis for make_hist"""
+    def __init__(self, n_bins, t_min, t_max):
+        self.n_bins = n_bins
+        self.t_min = t_min
+        self.t_max = t_max
+        self.title = ""
+
+    def SetTitle(self, title):
+        self.title = title
+
+    def FindBin(self, x):
+        if x < self.t_min: return 0
+        if x >= self.t_max: return self.n_bins + 1
+        return 1 + int(self.n_bins*(x - self.t_min)/(self.t_max - self.t_min))
+
+
+class StandInHist(object):
+    """
+    Pure python stand-in for TH1D/TH2D/TH3D used to benchmark make_hist
+    where ROOT is not available
+    """
+    def __init__(self, name, title, *axis_args):
+        self.name = name
+        self.title = title
+        self.dim = len(axis_args)//3
+        # like ROOT, lower dimension histograms still have y and z axes
+        axis_args = tuple(axis_args) + (1, 0, 1)*(3 - self.dim)
+        self.axes = [StandInAxis(*axis_args[i:i+3]) for i in range(0, 9, 3)]
+        self.contents = {}
+
+    def GetXaxis(self): return self.axes[0]
+    def GetYaxis(self): return self.axes[1]
+    def GetZaxis(self): return self.axes[2]
+
+    def Fill(self, *args):
+        weight = args[self.dim] if len(args) > self.dim else 1.0
+        bin = tuple(axis.FindBin(x)
+                    for axis, x in zip(self.axes[:self.dim], args))
+        self.contents[bin] = self.contents.get(bin, 0.0) + weight
+
+
+class StandInBackend(object):
+    """Stand-in for the ROOT module, see root_utilities.set_backend"""
+    __name__ = "StandInBackend"
+    TH1D = TH2D = TH3D = StandInHist
+
+
+@scenario("make_hist booking then filling 1D, 2D and 3D histograms")
+def make_hist_fill(scale, n_batches):
+    if not root_utilities.is_backend_available():
+        root_utilities.set_backend(StandInBackend())
+    root = root_utilities.get_backend()
+    if hasattr(root, 'TH1'):
+        # otherwise ROOT registers every histogram in gDirectory and spends
+        # the timed region replacing the previous pass's histograms
+        root.TH1.AddDirectory(False)
+    n_hists = _scaled(300, scale)
+    n_fills = 1000
+    points = [(random.gauss(0, 20), random.gauss(0, 20), random.gauss(0, 20))
+              for i in range(n_fills)]
+    def op(indices):
+        for i in indices:
+            dim = i%3 + 1
+            hist = root_utilities.make_hist("bench_h"+str(i), -50, 50,
+                                            ("x", "y", "z"), 20, dim)
+            for p in points:
+                hist.Fill(*p[:dim])
+    return [(lambda c=c: op(c), len(c)*(n_fills + 1))
+            for c in _split(range(n_hists), n_batches)], None
+
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        raise BenchmarkException("no values to take a percentile of")
+    rank = int(round(pct/100.0*(len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def run_scenario(name, repeats=5, warmup=1, scale=1.0, n_batches=100):
+    """
+    Run the named scenario, returns a dictionary of the results.
+
+    Each repeat is a pass over all of the scenario's batches, every batch
+    is timed separately. Latencies are per operation (batch time / number
+    of operations in the batch) in seconds, so the percentiles are taken
+    over repeats*n_batches samples. Memory is the peak resident set size
+    of the process in kB, peak_rss_delta_kb is how much of that was added
+    while running the scenario (after its inputs were built).
+    """
+    if name not in scenarios:
+        raise BenchmarkException("Unknown scenario: "+str(name))
+    random.seed(SEED)
+    batches, reset = scenarios[name][0](scale, n_batches)
+    # after the set up, so the delta doesn't include the input data
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in range(warmup):
+        if reset: reset()
+        for op, n_ops in batches:
+            op()
+    total_time = 0.0
+    latencies = []
+    for i in range(repeats):
+        if reset: reset()
+        for op, n_ops in batches:
+            start = default_timer()
+            op()
+            t = default_timer() - start
+            total_time += t
+            latencies.append(t/n_ops)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies.sort()
+    n_ops = sum(n for op, n in batches)
+    return {
+        'ops_per_pass':n_ops,
+        'batches':len(batches),
+        'repeats':repeats,
+        'ops_per_sec':n_ops*repeats/total_time,
+        'latency_min':latencies[0],
+        'latency_p50':percentile(latencies, 50),
+        'latency_p90':percentile(latencies, 90),
+        'latency_p99':percentile(latencies, 99),
+        'latency_max':latencies[-1],
+        'peak_rss_kb':rss_after,
+        'peak_rss_delta_kb':rss_after - rss_before,
+    }
+
+
+def _run_scenario_args(args):
+    return run_scenario(*args)
+
+
+def run_all(names=None, repeats=5, warmup=1, scale=1.0, n_batches=100,
+            isolate=True, verbose=True):
+    """
+    Run the named scenarios (default: all of them) and return a dictionary
+    of name:results. If isolate each scenario runs in a fresh process.
+    """
+    names = names if names else scenario_order
+    results = {}
+    for name in names:
+        args = (name, repeats, warmup, scale, n_batches)
+        if isolate:
+            pool = Pool(1)
+            try:
+                results[name] = pool.apply(_run_scenario_args, (args,))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results[name] = run_scenario(*args)
+        if verbose:
+            print format_result(name, results[name])
+    return results
+
+
+def format_result(name, res):
+    return "{:<22} {:>12.0f} ops/s  p50 {:>9.3f} us  p90 {:>9.3f} us  " \
+           "p99 {:>9.3f} us  peak {:>8d} kB".format(name, res['ops_per_sec'],
+            1e6*res['latency_p50'], 1e6*res['latency_p90'],
+            1e6*res['latency_p99'], res['peak_rss_kb'])
+
+
+# run settings that change the measurements, results made with different
+# settings can't be compared directly
+settings_keys = ('scale', 'repeats', 'warmup', 'batches')
+
+def get_metadata(settings):
+    """
+    Describe this machine and run, settings is a dictionary holding the
+    settings_keys
+    """
+    metadata = {
+        'date':strftime("%Y-%m-%d %H:%M:%S"),
+        'python':platform.python_version(),
+        'platform':platform.platform(),
+        'machine':platform.machine(),
+        'seed':SEED,
+        'make_hist_backend':'ROOT' if root_utilities.is_backend_available()
+                                   else 'stand-in',
+    }
+    for key in settings_keys:
+        metadata[key] = settings[key]
+    return metadata
+
+
+def get_settings_mismatches(baseline, settings):
+    """
+    Returns a list of (key, baseline value, value) for the settings_keys
+    that differ between the baseline and settings
+    """
+    return [(key, baseline['metadata'].get(key), settings[key])
+            for key in settings_keys
+            if baseline['metadata'].get(key) != settings[key]]
+
+
+def save_baseline(filename, results, settings):
+    with open(filename, 'w') as f:
+        json.dump({'metadata':get_metadata(settings), 'results':results}, f,
+                  indent=2, sort_keys=True)
+
+
+def load_baseline(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def find_regressions(results, baseline, tolerance=0.1, mem_tolerance=0.2,
+                     latency_tolerance=0.25):
+    """
+    Compare results to a saved baseline, returns a list of
+    (name, quantity, baseline value, new value) for every scenario whose
+    ops/sec fell by more than tolerance, whose p50 latency per operation
+    rose by more than latency_tolerance or whose peak memory increase grew
+    by more than mem_tolerance (all fractions).
+
+    p99 is a handful of samples so is too noisy to gate on, see
+    find_p99_changes.
+    """
+    regressions = []
+    for name, res in sorted(results.items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        if res['ops_per_sec'] < base['ops_per_sec']*(1 - tolerance):
+            regressions.append((name, 'ops_per_sec', base['ops_per_sec'],
+                                res['ops_per_sec']))
+        if res['latency_p50'] > base['latency_p50']*(1 + latency_tolerance):
+            regressions.append((name, 'latency_p50', base['latency_p50'],
+                                res['latency_p50']))
+        # ignore tiny allocations, they are dominated by noise
+        mem_limit = max(base['peak_rss_delta_kb']*(1 + mem_tolerance),
+                        base['peak_rss_delta_kb'] + 1024)
+        if res['peak_rss_delta_kb'] > mem_limit:
+            regressions.append((name, 'peak_rss_delta_kb',
+                                base['peak_rss_delta_kb'],
+                                res['peak_rss_delta_kb']))
+    return regressions
+
+
+def find_p99_changes(results, baseline, latency_tolerance=0.25):
+    """
+    Returns (name, baseline p99, new p99) for every scenario whose p99
+    latency rose by more than latency_tolerance, for information only
+    """
+    return [(name, baseline['results'][name]['latency_p99'],
+             res['latency_p99'])
+            for name, res in sorted(results.items())
+            if name in baseline['results'] and res['latency_p99'] >
+               baseline['results'][name]['latency_p99']*(1 + latency_tolerance)]
+
+
+def _make_result(ops_per_sec, latency_p50, latency_p99, peak_rss_delta_kb):
+    """A hand-built result with just the quantities that are compared"""
+    return {'ops_per_sec':ops_per_sec, 'latency_p50':latency_p50,
+            'latency_p99':latency_p99, 'peak_rss_delta_kb':peak_rss_delta_kb}
+
+
+def test_percentile():
+    print "Testing: percentile"
+    values = range(101)
+    for pct, expect in ((0, 0), (50, 50), (90, 90), (99, 99), (100, 100)):
+        assert percentile(values, pct) == expect
+    assert percentile([3.0], 99) == 3.0
+    try:
+        percentile([], 50)
+    except BenchmarkException, e:
+        print e, "Hooray if you see this!"
+    print "percentile passed all tests"
+
+
+def test_split():
+    print "Testing: _split"
+    expect = [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    res = _split(range(10), 3)
+    print "expect: ", expect
+    print "got:    ", res
+    assert res == expect
+    assert _split(range(3), 100) == [[0], [1], [2]]
+    assert _split([], 5) == []
+    print "_split passed all tests"
+
+
+def test_find_regressions():
+    print "Testing: find_regressions"
+    baseline = {'metadata':{}, 'results':{
+        'a':_make_result(1000.0, 1e-3, 2e-3, 10000),
+        'b':_make_result(1000.0, 1e-3, 2e-3, 100),
+    }}
+    # within tolerances (b's memory is within the 1024 kB floor and a's p99
+    # is never gated), 'c' isn't in the baseline so is ignored
+    results = {
+        'a':_make_result(950.0, 1.2e-3, 10e-3, 11000),
+        'b':_make_result(1000.0, 1e-3, 2e-3, 1000),
+        'c':_make_result(1.0, 1.0, 1.0, 10**6),
+    }
+    res = find_regressions(results, baseline)
+    print "expect no regressions, got:", res
+    assert res == []
+    assert find_p99_changes(results, baseline) == [('a', 2e-3, 10e-3)]
+
+    results = {
+        'a':_make_result(800.0, 1.5e-3, 2e-3, 13000),
+        'b':_make_result(1000.0, 1e-3, 2e-3, 1200),
+    }
+    expect = [('a', 'ops_per_sec', 1000.0, 800.0),
+              ('a', 'latency_p50', 1e-3, 1.5e-3),
+              ('a', 'peak_rss_delta_kb', 10000, 13000),
+              ('b', 'peak_rss_delta_kb', 100, 1200)]
+    res = find_regressions(results, baseline)
+    print "expect: ", expect
+    print "got:    ", res
+    assert res == expect
+    print "find_regressions passed all tests"
+
+
+def test_baseline_round_trip():
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    print "Testing: save_baseline/load_baseline"
+    settings = {'scale':0.5, 'repeats':3, 'warmup':1, 'batches':10}
+    results = {'a':_make_result(1000.0, 1e-3, 2e-3, 100)}
+    tmp_dir = mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "baseline.json")
+        save_baseline(filename, results, settings)
+        baseline = load_baseline(filename)
+    finally:
+        rmtree(tmp_dir)
+    assert baseline['results'] == results
+    for key in settings_keys:
+        assert baseline['metadata'][key] == settings[key]
+    assert get_settings_mismatches(baseline, settings) == []
+    settings['batches'] = 100
+    assert get_settings_mismatches(baseline, settings) == \
+           [('batches', 10, 100)]
+    assert find_regressions(results, baseline) == []
+    print "save_baseline/load_baseline passed all tests"
+
+
+def test():
+    test_percentile()
+    test_split()
+    test_find_regressions()
+    test_baseline_round_trip()
+    print "\nAll tests passed"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the utilities")
+    parser.add_argument("scenarios", nargs="*",
+                        help="Scenarios to run (default: all)")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="List the scenarios and exit")
+    parser.add_argument("--test", action="store_true",
+                        help="Run the internal tests and exit")
+    parser.add_argument("-r", "--repeats", default=5, type=int,
+                        help="Number of timed passes per scenario")
+    parser.add_argument("-w", "--warmup", default=1, type=int,
+                        help="Number of untimed passes per scenario")
+    parser.add_argument("-b", "--batches", default=100, type=int,
+                        help="Number of separately timed batches per pass")
+    parser.add_argument("-s", "--scale", default=1.0, type=float,
+                        help="Multiply the problem sizes by this")
+    parser.add_argument("--save", help="Save the results as a JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare against")
+    parser.add_argument("-t", "--tolerance", default=0.1, type=float,
+                        help="Allowed fractional drop in ops/sec")
+    parser.add_argument("--latency-tolerance", default=0.25, type=float,
+                        help="Allowed fractional rise in p50 latency")
+    parser.add_argument("--mem-tolerance", default=0.2, type=float,
+                        help="Allowed fractional rise in peak memory growth")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Don't run each scenario in a new process")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.test:
+        test()
+        return 0
+    if args.list:
+        for name in scenario_order:
+            print "{:<22} {}".format(name, scenarios[name][1])
+        return 0
+    for name in args.scenarios:
+        if name not in scenarios:
+            raise BenchmarkException("Unknown scenario: "+name)
+
+    settings = {'scale':args.scale, 'repeats':args.repeats,
+                'warmup':args.warmup, 'batches':args.batches}
+    baseline = load_baseline(args.compare) if args.compare else None
+    if baseline:
+        for key, old, new in get_settings_mismatches(baseline, settings):
+            print "WARNING: baseline was made with {} {} (now {})".format(
+                                                            key, old, new)
+
+    results = run_all(args.scenarios, args.repeats, args.warmup, args.scale,
+                      args.batches, isolate=not args.in_process)
+    if args.save:
+        save_baseline(args.save, results, settings)
+        print "Saved baseline to", args.save
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance,
+                                       args.mem_tolerance,
+                                       args.latency_tolerance)
+        for name, old, new in find_p99_changes(results, baseline,
+                                               args.latency_tolerance):
+            print "NOTE {}: latency_p99 {:.6g} -> {:.6g} (not gated)".format(
+                                                              name, old, new)
+        for name, quantity, old, new in regressions:
+            print "REGRESSION {}: {} {:.6g} -> {:.6g}".format(name, quantity,
+                                                              old, new)
+        if regressions:
+            return 1
+        print "No regressions against", args.compare
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+plot_export.py
+
+Export many histogram panels as multi-panel pages (images and PDFs)
+without opening any graphics.
+
+Panels are split into near-square pages, each page is drawn by a worker
+process from a pool and saved in every requested format. ROOT is used to
+draw the pages if it is available, otherwise matplotlib is used. One of
+the two must be installed, matplotlib is not needed if ROOT is.
+"""
+
+import os
+import pkgutil
+from multiprocessing import Pool, cpu_count
+
+from general_utilities import get_quantised_width_height
+import root_utilities
+
+
+class ExportException(Exception):
+    pass
+
+
+class Panel(object):
+    """
+    A single histogram to be drawn on a page.
+
+    The arguments are those of root_utilities.make_hist plus the points to
+    fill it with and the draw option. fills is a sequence of tuples, each
+    holding one coordinate per dimension optionally followed by a weight.
+    Panels only hold plain data so that they can be sent to the worker
+    processes, the histogram is booked by the worker that draws it.
+    """
+    def __init__(self, name, fills=(), mins=0, maxs=100, titles=None,
+                 bins=None, dim=1, des=None, draw_opt=""):
+        self.name = str(name)
+        self.fills = fills
+        self.mins = mins
+        self.maxs = maxs
+        self.titles = titles
+        self.bins = bins
+        self.dim = int(dim)
+        self.des = des
+        self.draw_opt = draw_opt
+
+    def __repr__(self):
+        return "Panel(name={!r}, dim={:d})".format(self.name, self.dim)
+
+    def make_hist(self):
+        """Book and fill the ROOT histogram for this panel"""
+        hist = root_utilities.make_hist(self.name, self.mins, self.maxs,
+                                        self.titles, self.bins, self.dim,
+                                        self.des)
+        for point in self.fills:
+            hist.Fill(*point)
+        return hist
+
+    def get_binning(self):
+        """Returns a list of (n_bins, min, max) for each axis"""
+        return [root_utilities.get_axis_binning(d, self.mins, self.maxs,
+                                                self.bins)
+                for d in range(self.dim)]
+
+
+def plan_pages(n_panels, max_per_page=6):
+    """
+    Split n_panels between pages holding at most max_per_page panels.
+
+    Returns a list of (n_x, n_y, panel_indices) for each page, where n_x and
+    n_y are the near-square grid from get_quantised_width_height for the
+    number of panels on that page.
+    """
+    if max_per_page < 1:
+        raise ExportException("max_per_page must be at least 1")
+    pages = []
+    for start in range(0, n_panels, max_per_page):
+        indices = range(start, min(start + max_per_page, n_panels))
+        n_x, n_y = get_quantised_width_height(len(indices))
+        pages.append((n_x, n_y, indices))
+    return pages
+
+
+def test_plan_pages():
+    print "Testing: plan_pages"
+    expect = [(3, 2, [0, 1, 2, 3, 4, 5]), (3, 2, [6, 7, 8, 9, 10, 11]),
+              (2, 1, [12, 13])]
+    res = plan_pages(14, 6)
+    print "expect: ", expect
+    print "got:    ", res
+    assert res == expect
+    assert plan_pages(0) == []
+    try:
+        plan_pages(5, 0)
+    except ExportException, e:
+        print e, "Hooray if you see this!"
+    print "plan_pages passed all tests"
+
+
+def draw_page_root(name, n_x, n_y, panels, paths):
+    """
+    Draw the panels on an off-screen ROOT canvas divided into n_x by n_y
+    pads and save it to each of paths (the format is taken from the
+    extension).
+
+    The caller's batch mode is restored afterwards, so this can be used from
+    an interactive session.
+    """
+    gROOT = root_utilities.get_backend().gROOT
+    was_batch = gROOT.IsBatch()
+    gROOT.SetBatch(True)
+    try:
+        canvas = root_utilities.make_canvas(name, n_x, n_y, resize=True)
+        # keep the histograms in scope until the canvas has been saved
+        hists = []
+        for i, panel in enumerate(panels):
+            canvas.cd(i+1)
+            hists.append(panel.make_hist())
+            hists[-1].Draw(panel.draw_opt)
+        for path in paths:
+            canvas.Print(path)
+        canvas.Close()
+    finally:
+        gROOT.SetBatch(was_batch)
+
+
+def draw_page_matplotlib(name, n_x, n_y, panels, paths):
+    """
+    Fallback for draw_page_root when ROOT is not available.
+
+    Uses matplotlib's Agg backend, draw options are ignored and 3D
+    histograms are drawn as their x-y projection.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+
+    # same size as the default canvas from make_canvas
+    figure, axes = pyplot.subplots(n_y, n_x, squeeze=False,
+                                   figsize=(14.36, 8.56), dpi=100)
+    figure.suptitle(name)
+    for i in range(n_x*n_y):
+        ax = axes[i//n_x][i%n_x]
+        if i >= len(panels):
+            ax.axis('off')
+            continue
+        panel = panels[i]
+        binning = panel.get_binning()
+        weights = [p[panel.dim] if len(p) > panel.dim else 1.0
+                   for p in panel.fills]
+        coords = [[p[d] for p in panel.fills] for d in range(min(panel.dim, 2))]
+        if panel.dim == 1:
+            n_bins, t_min, t_max = binning[0]
+            ax.hist(coords[0], bins=n_bins, range=(t_min, t_max),
+                    weights=weights, histtype='step')
+        else:
+            ax.hist2d(coords[0], coords[1],
+                      bins=[binning[0][0], binning[1][0]],
+                      range=[binning[0][1:], binning[1][1:]],
+                      weights=weights)
+        ax.set_title(panel.des if panel.des else panel.name)
+        titles = panel.titles if panel.titles else ()
+        if len(titles) >= 1: ax.set_xlabel(titles[0])
+        if len(titles) >= 2: ax.set_ylabel(titles[1])
+    for path in paths:
+        figure.savefig(path)
+    pyplot.close(figure)
+
+
+renderers = {'root':draw_page_root, 'matplotlib':draw_page_matplotlib}
+
+
+def get_default_renderer():
+    """
+    Returns the name of the renderer to use: 'root' if the ROOT backend can
+    be imported, otherwise 'matplotlib'.
+
+    ROOT is not imported here so the calling process doesn't pay for it.
+    """
+    if root_utilities.is_backend_available():
+        return 'root'
+    if pkgutil.find_loader('matplotlib') is None:
+        raise ExportException("Neither ROOT nor matplotlib is available")
+    return 'matplotlib'
+
+
+def export_page(job):
+    """
+    Draw and save a single page. job is a tuple of
+    (renderer, name, n_x, n_y, panels, paths), returns (name, paths).
+    """
+    renderer, name, n_x, n_y, panels, paths = job
+    renderers[renderer](name, n_x, n_y, panels, paths)
+    return name, paths
+
+
+def export_pages(panels, out_dir, formats=('png', 'pdf'), max_per_page=6,
+                 processes=None, renderer=None, prefix='page', verbose=True):
+    """
+    Split the panels into pages (see plan_pages) and save each page in
+    out_dir as <prefix>_<page number>.<format> for each of formats.
+
+    The pages are drawn by a pool of worker processes (default: one per
+    core), processes=1 draws them in this process instead. renderer is
+    one of the keys of renderers, by default ROOT is used if available.
+    If verbose the progress is printed as each page is finished.
+
+    Returns the list of files written, in page order.
+    """
+    renderer = renderer if renderer else get_default_renderer()
+    if renderer not in renderers:
+        raise ExportException("Unknown renderer: "+str(renderer))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    pages = plan_pages(len(panels), max_per_page)
+    jobs = []
+    for page_number, (n_x, n_y, indices) in enumerate(pages):
+        name = "{}_{:04d}".format(prefix, page_number)
+        paths = [os.path.join(out_dir, name+"."+fmt) for fmt in formats]
+        jobs.append((renderer, name, n_x, n_y,
+                     [panels[i] for i in indices], paths))
+
+    processes = processes if processes else cpu_count()
+    processes = min(processes, len(jobs))
+    pool = Pool(processes) if processes > 1 else None
+    try:
+        results = pool.imap_unordered(export_page, jobs) if pool \
+                  else (export_page(job) for job in jobs)
+        for n_done, (name, paths) in enumerate(results):
+            if verbose:
+                print "Exported {} ({}/{})".format(name, n_done+1, len(jobs))
+    except:
+        # don't wait for the remaining pages to be drawn
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+    return [path for job in jobs for path in job[-1]]
+
+
+def draw_page_stub(name, n_x, n_y, panels, paths):
+    """
+    Test renderer: writes the grid and panel names to each of paths
+    instead of drawing anything
+    """
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write("{} {}x{} {}\n".format(name, n_x, n_y,
+                                           " ".join(p.name for p in panels)))
+
+
+def test_export_pages_stub():
+    """Test the pagination, pool and output paths without a real renderer"""
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    print "Testing: export_pages with a stub renderer"
+    # registered before the pool is made so the forked workers see it
+    renderers['stub'] = draw_page_stub
+    panels = [Panel("h_"+str(i)) for i in range(13)]
+    expect = ["page_0000 2x2 h_0 h_1 h_2 h_3", "page_0001 2x2 h_4 h_5 h_6 h_7",
+              "page_0002 2x2 h_8 h_9 h_10 h_11", "page_0003 1x1 h_12"]
+    out_dir = mkdtemp()
+    try:
+        for processes in (1, 2):
+            files = export_pages(panels, out_dir, max_per_page=4,
+                                 processes=processes, renderer='stub')
+            expect_files = [os.path.join(out_dir, "page_{:04d}.{}".format(i, f))
+                            for i in range(4) for f in ('png', 'pdf')]
+            assert files == expect_files
+            got = [open(f).read().strip() for f in files[::2]]
+            print "expect: ", expect
+            print "got:    ", got
+            assert got == expect
+    finally:
+        rmtree(out_dir)
+        del renderers['stub']
+    print "export_pages (stub) passed all tests"
+
+
+def test_export_pages():
+    from random import gauss, seed
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    try:
+        renderer = get_default_renderer()
+    except ExportException, e:
+        print e, "- skipping export_pages test with a real renderer"
+        return
+    seed(42)
+    panels = []
+    for i in range(9):
+        dim = i%3 + 1
+        fills = [tuple(gauss(0, 20) for d in range(dim)) for n in range(1000)]
+        panels.append(Panel("h_"+str(i), fills, mins=-50, maxs=50, bins=20,
+                            titles=("x", "y", "z"), dim=dim))
+    out_dir = mkdtemp()
+    try:
+        files = export_pages(panels, out_dir, max_per_page=4,
+                             renderer=renderer)
+        print "Expect 6 files, got:", len(files)
+        assert len(files) == 6
+        for f in files: assert os.path.isfile(f)
+    finally:
+        rmtree(out_dir)
+    print "export_pages passed all tests"
+
+
+if __name__ == '__main__':
+    test_plan_pages()
+    test_export_pages_stub()
+    test_export_pages()
@@ -8,8 +8,11 @@ Created by Sam Cook on 2012-07-25.
 Generally useful functions for dealing with ROOT objects
 """
 
-from ROOT import gROOT, TFile, TTree, TBranch, TCanvas, TLegend, \
-                 TH1D, TH2D, TH3D, TF1
+import os
+import pkgutil
+import sys
+from importlib import import_module
+from time import time
 
 from general_utilities import get_quantised_width_height, \
                                 increment_counter_attribute
@@ -23,7 +26,104 @@ class ROOTException(Exception):
     pass
 
 
-  
+# ROOT takes seconds to import so it is only loaded the first time one of 
+# the functions below actually needs it (see get_backend). The backend 
+# module can be changed with the ROOT_UTILITIES_BACKEND environment 
+# variable or set_backend.
+_backend_name = os.environ.get('ROOT_UTILITIES_BACKEND', 'ROOT')
+_backend = None
+# Seconds spent importing the backend, None until it has been loaded
+backend_import_time = None
+# Print the backend import time to stderr when it is loaded
+log_backend_load = bool(os.environ.get('ROOT_UTILITIES_LOG_LOAD'))
+
+
+def set_backend(backend):
+    """
+    Select the module that provides the ROOT classes (gROOT, TFile, TCanvas,
+    TH1D etc.). 
+    
+    backend can be the name of a module, which will be imported the next 
+    time it is needed, or an object that already provides those classes.
+    """
+    global _backend_name, _backend, backend_import_time
+    if isinstance(backend, basestring):
+        _backend_name = backend
+        _backend = None
+        backend_import_time = None
+    else:
+        _backend_name = getattr(backend, '__name__', repr(backend))
+        _backend = backend
+        backend_import_time = 0.0
+
+
+def get_backend():
+    """
+    Returns the ROOT backend module, importing it on the first call.
+    
+    On X11 platforms ROOT is put into batch mode if there is no display
+    (DISPLAY is not set) so that no graphics windows are opened, macOS and
+    Windows don't use DISPLAY so are left alone. The time taken by the 
+    import is stored in backend_import_time and, if log_backend_load is 
+    true (or ROOT_UTILITIES_LOG_LOAD is set), printed to stderr.
+    """
+    global _backend, backend_import_time
+    if _backend is None:
+        start = time()
+        _backend = import_module(_backend_name)
+        backend_import_time = time() - start
+        if log_backend_load:
+            print >> sys.stderr, "root_utilities: imported %s in %.3f s"%(
+                                        _backend_name, backend_import_time)
+        if not has_display() and hasattr(_backend, 'gROOT'):
+            _backend.gROOT.SetBatch(True)
+    return _backend
+
+
+def has_display():
+    """
+    Returns False if this is an X11 platform without a DISPLAY, otherwise 
+    True (macOS and Windows draw without X so are assumed to have one)
+    """
+    if sys.platform == 'darwin' or sys.platform.startswith('win'):
+        return True
+    return bool(os.environ.get('DISPLAY'))
+
+
+def is_backend_loaded():
+    """Returns True if the ROOT backend has already been imported"""
+    return _backend is not None
+
+
+def is_backend_available():
+    """
+    Returns True if the ROOT backend can be imported, without importing it
+    """
+    if _backend is not None:
+        return True
+    try:
+        return pkgutil.find_loader(_backend_name) is not None
+    except ImportError:
+        return False
+
+
+def get_axis_binning(axis, mins=0, maxs=100, bins=None):
+    """
+    Returns (n_bins, min, max) for the given axis index following the 
+    make_hist conventions for mins, maxs and bins.
+    """
+    t_min = mins if not hasattr(mins, '__len__') else mins[axis]
+    t_max = maxs if not hasattr(maxs, '__len__') else maxs[axis]
+    if hasattr(bins, '__len__'):
+        t_bin = bins[axis]
+    elif bins:
+        t_bin = bins
+    else:
+        t_bin = int(t_max - t_min) if int(t_max - t_min) > 1 else 1
+    if (t_min>t_max): raise ROOTException("min > max!")
+    return t_bin, t_min, t_max
+
+
 
 def make_hist(name, mins=0, maxs=100, titles=None, bins=None, dim=1, des=None):
     """
@@ -47,23 +147,15 @@ def make_hist(name, mins=0, maxs=100, titles=None, bins=None, dim=1, des=None):
     # make the argument list
     args = [name, description,]
     for d in range(dim):
-        t_min = mins if not hasattr(mins, '__len__') else mins[d]
-        t_max = maxs if not hasattr(maxs, '__len__') else maxs[d]
-        if hasattr(bins, '__len__'):
-            t_bin = bins[d]
-        elif bins:
-            t_bin = bins
-        else:
-            t_bin = int(t_max - t_min) if int(t_max - t_min) > 1 else 1
-        if (t_min>t_max): raise ROOTException("min > max!")
-        args += [t_bin, t_min, t_max]
+        args += get_axis_binning(d, mins, maxs, bins)
     
+    root = get_backend()
     if dim == 1:
-        res = TH1D(*args)
+        res = root.TH1D(*args)
     elif dim == 2:
-        res = TH2D(*args)
+        res = root.TH2D(*args)
     elif dim == 3:
-        res = TH3D(*args)
+        res = root.TH3D(*args)
     # Checking titles exists stops len raising an error if it doesn't 
     if titles and len(titles) >= 1: res.GetXaxis().SetTitle(titles[0])
     if titles and len(titles) >= 2: res.GetYaxis().SetTitle(titles[1])
@@ -99,8 +191,10 @@ def test_make_hist():
     except ROOTException, e:
         print e, "Hooray if you see this!"
     
+    print "%s imported in %.3f s"%(_backend_name, backend_import_time)
     print "All tests passed (assuming visual inspection of histograms)"
-    sleep (10)
+    # nothing to look at in batch mode so don't wait around
+    if not get_backend().gROOT.IsBatch(): sleep (10)
 
 
 def rebin_nbins(hist, n_bins, new_name=''):
@@ -139,6 +233,7 @@ def make_canvas(name, n_x=0, n_y=0, resize=False, _w=1436, _h=856):
     height (_h), the default will maximise the canvas on a 1440x900 screen
     """
     name = str(name) # make sure we have a string
+    TCanvas = get_backend().TCanvas
     canvas = TCanvas(name, name,_w,_h) if resize else TCanvas(name,name) 
     if n_x or n_y: canvas.Divide(n_x, n_y)
     return canvas
@@ -152,7 +247,7 @@ def get_tree_from_file(treename, filename):
   attribute of the tree (.file), along with the filename 
   (.filename)
   """
-  file = TFile(filename,"READ")
+  file = get_backend().TFile(filename,"READ")
   tree = file.Get(treename)
   tree.file = file
   tree.filename = filename